@@ -1,6 +1,7 @@
 from fastapi import HTTPException, Path
-import os
-from ..core.config import settings
+from ..services.job_manager import JobManager
+
+job_manager = JobManager()
 
 async def verify_job_id(
     job_id: str = Path(..., description="The ID of the generation job")
@@ -8,7 +9,6 @@ async def verify_job_id(
     """
     Dependency to verify that a job exists and return its ID.
     """
-    job_path = settings.JOBS_DIR / job_id
-    if not job_path.exists():
+    if await job_manager.get_job(job_id) is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return job_id 
\ No newline at end of file
+    return job_id
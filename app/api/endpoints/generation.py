@@ -1,10 +1,12 @@
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
-import uuid
+from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
+import asyncio
+import shutil
 from PIL import Image
-import io
+import numpy as np
 import logging
 from pathlib import Path
+from typing import Optional
 
 from ...models.generation import (
     GenerationParams,
@@ -13,50 +15,64 @@ from ...models.generation import (
     JobStatus
 )
 from ...core.config import settings
-from ...services.job_manager import JobManager
-from ..deps import verify_job_id
+from ...services.job_manager import ModelUnavailableError
+from ...services.job_store import JobRecord
+from ..deps import job_manager, verify_job_id
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
-job_manager = JobManager()
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+SSE_KEEPALIVE_INTERVAL = 15  # Seconds between keepalive comments on status streams
+
+# Leading bytes of the image formats accepted for upload
+IMAGE_SIGNATURES = (
+    b"\x89PNG\r\n\x1a\n",  # PNG
+    b"\xff\xd8\xff",  # JPEG
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",  # BMP
+    b"II*\x00",  # TIFF, little-endian
+    b"MM\x00*",  # TIFF, big-endian
+)
+
+def _looks_like_image(head: bytes) -> bool:
+    """Check the first bytes of an upload against known image signatures."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head.startswith(IMAGE_SIGNATURES)
+
+def _discard_job_dir(job_dir: Optional[Path]):
+    """Remove the directory of an upload that failed, so it is not picked up as a job."""
+    if job_dir is not None:
+        shutil.rmtree(job_dir, ignore_errors=True)
 
 @router.post("/upload/", response_model=JobResponse)
 async def upload_image(
     file: UploadFile = File(..., description="Image file to process")
 ) -> JobResponse:
     """Upload an image for processing."""
+    # Set once the job directory exists, so any later failure removes it again
+    job_dir: Optional[Path] = None
     try:
         # Log the upload attempt
         logger.info(f"Received upload request for file: {file.filename}")
 
-        # Validate image
-        contents = await file.read()
-        logger.info(f"Read {len(contents)} bytes from file")
-
-        try:
-            image = Image.open(io.BytesIO(contents))
-            logger.info(f"Successfully opened image with size: {image.size}")
-        except Exception as e:
-            logger.error(f"Failed to open image: {str(e)}")
+        # Reject non-images from their magic bytes before storing or decoding anything
+        head = await file.read(32)
+        if not _looks_like_image(head):
+            logger.error(f"Rejected upload with unknown signature: {file.filename}")
             raise HTTPException(
                 status_code=400,
-                detail=f"Invalid image file: {str(e)}"
+                detail="Invalid image file: unsupported or unrecognized format"
             )
-
-        # Resize image if too large while maintaining aspect ratio
-        original_size = image.size
-        new_size = original_size
-        if max(image.size) > settings.MAX_IMAGE_SIZE:
-            ratio = settings.MAX_IMAGE_SIZE / max(image.size)
-            new_size = tuple(int(dim * ratio) for dim in image.size)
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
-            logger.info(f"Resized image from {original_size} to {new_size}")
+        await file.seek(0)
 
         # Create job
-        job_id = str(uuid.uuid4())
-        job_dir = settings.JOBS_DIR / job_id
+        job_id = job_manager.new_job_id()
         try:
-            job_dir.mkdir(parents=True, exist_ok=True)
+            # JOBS_DIR is created at startup, so a single mkdir is enough
+            (settings.JOBS_DIR / job_id).mkdir()
+            job_dir = settings.JOBS_DIR / job_id
             logger.info(f"Created job directory: {job_dir}")
         except Exception as e:
             logger.error(f"Failed to create job directory: {str(e)}")
@@ -65,10 +81,65 @@ async def upload_image(
                 detail=f"Failed to create job directory: {str(e)}"
             )
 
-        # Save image
-        image_path = job_dir / "input.png"
+        # Stream the upload to disk instead of buffering it in memory
+        upload_path = job_dir / "upload.bin"
+        try:
+            with open(upload_path, "wb") as out:
+                await asyncio.to_thread(shutil.copyfileobj, file.file, out, UPLOAD_CHUNK_SIZE)
+            logger.info(f"Wrote {upload_path.stat().st_size} bytes to {upload_path}")
+        except Exception as e:
+            logger.error(f"Failed to store upload: {str(e)}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to store upload: {str(e)}"
+            )
+
+        # Decode, validate and resize image
+        try:
+            image = Image.open(upload_path)
+            original_size = image.size
+            # Let the JPEG decoder downscale by a power of two while decoding
+            if max(image.size) > settings.MAX_IMAGE_SIZE:
+                ratio = settings.MAX_IMAGE_SIZE / max(image.size)
+                image.draft("RGB", tuple(int(dim * ratio) for dim in image.size))
+            image.load()
+            logger.info(f"Successfully opened image with size: {image.size}")
+
+            # Convert before any resizing: reduce() rejects palette, 1-bit and
+            # 16-bit modes, and generation needs RGB anyway
+            image = image.convert("RGB")
+
+            # Resize image if still too large while maintaining aspect ratio
+            if max(image.size) > settings.MAX_IMAGE_SIZE:
+                # Cheap integer-factor box reduction first, then the residual fractional resize
+                factor = max(image.size) // settings.MAX_IMAGE_SIZE
+                if factor > 1:
+                    image = image.reduce(factor)
+                ratio = settings.MAX_IMAGE_SIZE / max(image.size)
+                image = image.resize(
+                    tuple(int(dim * ratio) for dim in image.size),
+                    Image.Resampling[settings.RESAMPLE_FILTER]
+                )
+        except Exception as e:
+            logger.error(f"Failed to decode image: {str(e)}")
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid image file: {str(e)}"
+            )
+
+        new_size = image.size
+        if new_size != original_size:
+            logger.info(f"Resized image from {original_size} to {new_size}")
+
+        # Keep the decoded RGB array in memory for the worker, and on disk as raw
+        # .npy (no PNG encode/decode) so the job survives a restart
+        input_image = np.asarray(image)
+        image_path = job_dir / "input.npy"
         try:
-            image.save(image_path)
+            np.save(image_path, input_image)
+            upload_path.unlink()
+            await job_manager.create_job(job_id)
+            job_manager.cache_input(job_id, input_image)
             logger.info(f"Saved image to: {image_path}")
         except Exception as e:
             logger.error(f"Failed to save image: {str(e)}")
@@ -85,8 +156,10 @@ async def upload_image(
         )
 
     except HTTPException:
+        _discard_job_dir(job_dir)
         raise
     except Exception as e:
+        _discard_job_dir(job_dir)
         logger.error(f"Unexpected error during upload: {str(e)}")
         raise HTTPException(
             status_code=500,
@@ -96,24 +169,25 @@ async def upload_image(
 @router.post("/{job_id}/generate/", response_model=JobResponse)
 async def generate_images(
     params: GenerationParams,
-    background_tasks: BackgroundTasks,
     job_id: str = Depends(verify_job_id)
 ) -> JobResponse:
     """Start image generation for a job."""
     try:
-        # Start processing in background
-        background_tasks.add_task(
-            job_manager.process_job,
-            job_id,
-            params
-        )
+        # Hand the job to the worker pool
+        await job_manager.process_job(job_id, params)
 
-        logger.info(f"Started generation for job: {job_id}")
+        logger.info(f"Queued generation for job: {job_id}")
         return JobResponse(
             job_id=job_id,
-            status=JobStatus.PROCESSING,
-            message="Generation started"
+            status=JobStatus.PENDING,
+            message="Generation queued"
         )
+    except asyncio.QueueFull:
+        logger.warning(f"Job queue full, rejecting job: {job_id}")
+        raise HTTPException(status_code=503, detail="Job queue is full, try again later")
+    except ModelUnavailableError as e:
+        logger.error(f"Rejecting job {job_id}: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Generation failed: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -124,26 +198,53 @@ async def get_job_status(
 ) -> GenerationResponse:
     """Get the current status of a job."""
     try:
-        status = job_manager.get_job_status(job_id)
+        return _job_response(job_id, await job_manager.get_job(job_id))
 
-        # If job is completed, return results
-        if status == JobStatus.COMPLETED:
-            job_dir = settings.JOBS_DIR / job_id
-            result_files = [f.name for f in job_dir.glob("result_*.png")]
-            return GenerationResponse(
-                job_id=job_id,
-                status=status,
-                images=result_files
-            )
+    except Exception as e:
+        logger.error(f"Status check failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/{job_id}/stream/")
+async def stream_job_status(
+    job_id: str = Depends(verify_job_id)
+) -> StreamingResponse:
+    """Stream status changes of a job as Server-Sent Events until it finishes."""
+    async def event_source():
+        records = job_manager.watch_job(job_id)
+        next_record = asyncio.ensure_future(records.__anext__())
+        try:
+            while True:
+                # Send a comment line while waiting so clients' read timeouts don't fire
+                done, _ = await asyncio.wait({next_record}, timeout=SSE_KEEPALIVE_INTERVAL)
+                if not done:
+                    yield ": keepalive\n\n"
+                    continue
+                try:
+                    record = next_record.result()
+                except StopAsyncIteration:
+                    return
+                yield f"data: {_job_response(job_id, record).model_dump_json()}\n\n"
+                next_record = asyncio.ensure_future(records.__anext__())
+        finally:
+            if not next_record.done():
+                next_record.cancel()
+                await asyncio.gather(next_record, return_exceptions=True)
+
+    return StreamingResponse(event_source(), media_type="text/event-stream")
+
+def _job_response(job_id: str, record: JobRecord) -> GenerationResponse:
+    """Build the status response for a job, including results once completed."""
+    if record.status == JobStatus.COMPLETED:
         return GenerationResponse(
             job_id=job_id,
-            status=status
+            status=record.status,
+            images=record.result_files
         )
 
-    except Exception as e:
-        logger.error(f"Status check failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    return GenerationResponse(
+        job_id=job_id,
+        status=record.status
+    )
 
 @router.get("/{job_id}/result/{image_name}")
 async def get_result_image(
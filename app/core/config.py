@@ -6,6 +6,7 @@ class Settings(BaseSettings):
     # API Settings
     API_V1_STR: str = "/api/v1"
     PROJECT_NAME: str = "ControlNet API"
+    API_BASE_URL: str = "http://localhost:8000/api/v1/generation"  # Used by the generate_image client
     
     # Model Settings
     MODEL_PATH: str = "./models/control_sd15_canny.pth"
@@ -14,9 +15,16 @@ class Settings(BaseSettings):
     # Processing Settings
     JOBS_DIR: Path = Path("jobs")
     MAX_IMAGE_SIZE: int = 2048
+    RESAMPLE_FILTER: str = "LANCZOS"  # Name of a PIL.Image.Resampling member
+    PNG_COMPRESS_LEVEL: int = 1  # zlib level for result PNGs (0-9, lower is faster)
+    JOB_QUEUE_SIZE: int = 32
+    REDIS_URL: Optional[str] = None  # Share job state across API workers via Redis
+    INPUT_CACHE_SIZE: int = 16  # Uploaded images kept in memory awaiting generation
     
     # GPU Settings
     FORCE_CPU: bool = False
+    HALF_PRECISION: bool = True  # Run UNet, ControlNet and text encoder in bf16/fp16 on CUDA
+    TORCH_COMPILE: bool = False  # Compile the diffusion UNet with torch.compile on CUDA (experimental)
     
     class Config:
         case_sensitive = True
@@ -1,9 +1,12 @@
 from fastapi import FastAPI
+import asyncio
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import logging
 
 from .core.config import settings
 from .api.endpoints import generation
+from .api.deps import job_manager
 
 # Configure logging
 logging.basicConfig(
@@ -13,7 +16,8 @@ logging.basicConfig(
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
-    openapi_url=f"{settings.API_V1_STR}/openapi.json"
+    openapi_url=f"{settings.API_V1_STR}/openapi.json",
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS
@@ -35,10 +39,38 @@ app.include_router(
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
-    return {"status": "healthy"}
+    if job_manager.startup_error is not None:
+        return ORJSONResponse(
+            status_code=503,
+            content={
+                "status": "unhealthy",
+                "model_loaded": False,
+                "error": str(job_manager.startup_error)
+            }
+        )
+    return {"status": "healthy", "model_loaded": job_manager.controlnet is not None}
+
+def _on_job_manager_started(task: asyncio.Task):
+    """Log a failed model load; the job manager keeps the error for /health and /generate/."""
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        logging.error(f"Failed to initialize ControlNet model: {str(error)}")
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize services on startup."""
     settings.JOBS_DIR.mkdir(parents=True, exist_ok=True)
-    logging.info(f"Initialized {settings.PROJECT_NAME}") 
\ No newline at end of file
+    await job_manager.load_jobs()
+    # Load the model in the background so the API is up immediately;
+    # jobs submitted meanwhile wait in the queue
+    app.state.job_manager_start = asyncio.create_task(job_manager.start())
+    app.state.job_manager_start.add_done_callback(_on_job_manager_started)
+    logging.info(f"Initialized {settings.PROJECT_NAME}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background workers on shutdown."""
+    app.state.job_manager_start.cancel()
+    await job_manager.stop_workers()
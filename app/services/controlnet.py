@@ -1,69 +1,163 @@
+import asyncio
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import torch
-import cv2
 import numpy as np
-import einops
+import kornia
 from PIL import Image
 import logging
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
+import json
 import requests
-import time
 
 from ..core.config import settings
 from ..models.generation import GenerationParams, JobStatus
 from annotator.util import resize_image, HWC3
-from annotator.canny import CannyDetector
 from cldm.model import create_model, load_state_dict
 from cldm.ddim_hacked import DDIMSampler
 
 logger = logging.getLogger(__name__)
 
+TEXT_CACHE_SIZE = 64
+STREAM_TIMEOUT = 60  # Seconds to wait for the next status event
+
 
 class ControlNetService:
     def __init__(self):
         self.device = torch.device("cuda" if torch.cuda.is_available() and not settings.FORCE_CPU else "cpu")
         logger.info(f"Using device: {self.device}")
+        self.dtype = self._select_dtype()
+        logger.info(f"Using inference dtype: {self.dtype}")
 
-        self.apply_canny = CannyDetector()
+        # All torch work runs on this single thread so the event loop stays free
+        # and CUDA calls are always issued from the same thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="controlnet")
 
         logger.info("Initializing ControlNet model...")
         self.model = self._initialize_model()
         self.ddim_sampler = DDIMSampler(self.model)
+        # The text encoder is frozen, so embeddings for repeated prompts can be reused
+        self._text_cache: "OrderedDict[str, torch.Tensor]" = OrderedDict()
         logger.info("Model initialized successfully")
 
     def _initialize_model(self):
         model = create_model(settings.MODEL_CONFIG).cpu()
+        # Memory-map the checkpoint so weights are paged in as they are copied
+        # into the model rather than read into a second full copy in RAM
         model.load_state_dict(load_state_dict(
             settings.MODEL_PATH,
-            location='cuda' if torch.cuda.is_available() and not settings.FORCE_CPU else 'cpu'
+            location='cpu',
+            mmap=True
         ))
-        return model.to(self.device)
+        if self.dtype != torch.float32:
+            # Cast on the CPU so only the half precision weights are moved to the GPU.
+            # The VAE and the noise schedule buffers stay in fp32 for numerical safety
+            for module in (model.model, model.control_model, model.cond_stage_model):
+                module.to(self.dtype)
+        model = model.to(self.device)
+
+        if settings.TORCH_COMPILE and self.device.type == "cuda" and hasattr(torch, "compile"):
+            # Static shapes: each (num_samples, H, W) gets its own compiled graph,
+            # built on first use and reused afterwards. CUDA graphs ("reduce-overhead")
+            # are not used: ddim_hacked calls apply_model twice per step and reads the
+            # first output after the second call, which a graph replay would overwrite
+            logger.info("Compiling diffusion model with torch.compile")
+            model.model.diffusion_model = torch.compile(
+                model.model.diffusion_model,
+                fullgraph=False,
+                dynamic=False
+            )
+        return model
+
+    def _select_dtype(self) -> torch.dtype:
+        """Pick the reduced precision dtype for inference, preferring bf16."""
+        if not settings.HALF_PRECISION or self.device.type != "cuda":
+            return torch.float32
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+    def _autocast(self):
+        """Autocast context for the configured dtype (a no-op in fp32)."""
+        if self.dtype == torch.float32:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def _encode(self, texts: List[str], num_samples: int) -> List[torch.Tensor]:
+        """
+        Encode prompts with the CLIP text encoder, each repeated num_samples times.
+
+        Prompts missing from the cache are encoded together in a single forward pass.
+        """
+        missing = [text for text in dict.fromkeys(texts) if text not in self._text_cache]
+        if missing:
+            embeddings = self.model.get_learned_conditioning(missing)
+            for text, embedding in zip(missing, embeddings):
+                self._text_cache[text] = embedding.unsqueeze(0)
+
+        results = []
+        for text in texts:
+            self._text_cache.move_to_end(text)
+            results.append(self._text_cache[text].repeat(num_samples, 1, 1))
+        while len(self._text_cache) > TEXT_CACHE_SIZE:
+            self._text_cache.popitem(last=False)
+        return results
+
+    @staticmethod
+    def _canny_thresholds(params: GenerationParams) -> Tuple[float, float]:
+        """
+        Map the 0-255 API thresholds onto kornia's open (0, 1) range.
+
+        Like cv2.Canny, a reversed pair is swapped rather than rejected.
+        """
+        low, high = sorted((params.low_threshold, params.high_threshold))
+        return tuple(min(max(value, 1), 254) / 255.0 for value in (low, high))
 
     async def process_image(
         self,
         job_id: str,
-        params: GenerationParams
+        params: GenerationParams,
+        input_image: Optional[np.ndarray] = None
     ) -> List[str]:
         """
         Process an image with the given parameters and return paths to generated images.
+
+        If input_image (an RGB array) is not given it is loaded from the job directory.
         """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._process_sync, job_id, params, input_image
+        )
+
+    def _process_sync(
+        self,
+        job_id: str,
+        params: GenerationParams,
+        input_image: Optional[np.ndarray] = None
+    ) -> List[str]:
+        """Blocking implementation of process_image, run on the inference thread."""
         try:
             # Setup paths
             job_dir = settings.JOBS_DIR / job_id
-            input_path = job_dir / "input.png"
 
-            # Read and preprocess input image
-            input_image = self._load_image(str(input_path))
+            # Read input image unless it was handed over from the upload
+            if input_image is None:
+                input_image = self._load_image(job_dir)
 
             # Generate images
             results = self._generate(input_image, params)
 
-            # Save results
-            result_paths = []
-            for idx, result in enumerate(results):
-                output_path = job_dir / f"result_{idx}.png"
-                Image.fromarray(result).save(output_path)
-                result_paths.append(f"result_{idx}.png")
+            # Save results in parallel; PIL releases the GIL while encoding
+            result_paths = [f"result_{idx}.png" for idx in range(len(results))]
+            with ThreadPoolExecutor(max_workers=len(results)) as pool:
+                list(pool.map(
+                    lambda name, result: Image.fromarray(result).save(
+                        job_dir / name,
+                        compress_level=settings.PNG_COMPRESS_LEVEL
+                    ),
+                    result_paths,
+                    results
+                ))
 
             return result_paths
 
@@ -71,12 +165,20 @@ class ControlNetService:
             logger.error(f"Error processing image: {str(e)}")
             raise
 
-    def _load_image(self, image_path: str) -> np.ndarray:
-        """Load and preprocess input image."""
-        image = cv2.imread(image_path)
-        if image is None:
-            raise ValueError("Failed to load input image")
-        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    def _load_image(self, job_dir: Path) -> np.ndarray:
+        """
+        Load the RGB input array saved at upload.
+
+        Jobs uploaded before inputs were stored as .npy only have input.png.
+        """
+        npy_path = job_dir / "input.npy"
+        try:
+            if npy_path.exists():
+                return np.load(npy_path)
+            with Image.open(job_dir / "input.png") as image:
+                return np.asarray(image.convert("RGB"))
+        except OSError as e:
+            raise ValueError(f"Failed to load input image: {str(e)}")
 
     def _generate(
         self,
@@ -84,59 +186,63 @@ class ControlNetService:
         params: GenerationParams
     ) -> List[np.ndarray]:
         """Generate images using ControlNet."""
-        with torch.no_grad():
+        with torch.inference_mode():
             # Resize input image
             img = resize_image(HWC3(input_image), params.image_resolution)
             H, W, C = img.shape
 
-            # Apply Canny edge detection
-            detected_map = self.apply_canny(img, params.low_threshold, params.high_threshold)
-            detected_map = HWC3(detected_map)
+            # Apply Canny edge detection on the device the model runs on. kornia blurs
+            # before the gradient and scales thresholds differently from cv2.Canny, so
+            # edge maps are not directly comparable to the previous OpenCV output
+            img_t = torch.from_numpy(img).to(self.device, dtype=torch.float32)
+            img_t = img_t.permute(2, 0, 1).unsqueeze(0) / 255.0
+            low_threshold, high_threshold = self._canny_thresholds(params)
+            _, edges = kornia.filters.canny(
+                img_t.mean(1, keepdim=True),
+                low_threshold=low_threshold,
+                high_threshold=high_threshold
+            )
 
-            # Prepare control signal
-            control = torch.from_numpy(detected_map.copy()).float().to(self.device) / 255.0
-            control = torch.stack([control for _ in range(params.num_samples)], dim=0)
-            control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+            # Prepare control signal: the edge map as 3 channels, one per sample.
+            # A broadcast view is enough, apply_model concatenates c_concat anyway
+            control = edges.to(self.dtype).expand(params.num_samples, 3, -1, -1)
 
             # Set random seed
             if params.seed != -1:
                 torch.manual_seed(params.seed)
                 np.random.seed(params.seed)
 
-            # Prepare conditioning
-            cond = {
-                "c_concat": [control],
-                "c_crossattn": [
-                    self.model.get_learned_conditioning(
-                        [f"{params.prompt}, {params.a_prompt}"] * params.num_samples
-                    )
-                ]
-            }
-            un_cond = {
-                "c_concat": [control],
-                "c_crossattn": [
-                    self.model.get_learned_conditioning(
-                        [params.n_prompt] * params.num_samples
-                    )
-                ]
-            }
-
-            shape = (4, H // 8, W // 8)
-            samples, _ = self.ddim_sampler.sample(
-                params.ddim_steps,
-                params.num_samples,
-                shape,
-                cond,
-                verbose=False,
-                eta=params.eta,
-                unconditional_guidance_scale=params.scale,
-                unconditional_conditioning=un_cond
-            )
-
-            x_samples = self.model.decode_first_stage(samples)
+            with self._autocast():
+                # Prepare conditioning
+                cond_emb, un_cond_emb = self._encode(
+                    [f"{params.prompt}, {params.a_prompt}", params.n_prompt],
+                    params.num_samples
+                )
+                cond = {"c_concat": [control], "c_crossattn": [cond_emb]}
+                un_cond = {"c_concat": [control], "c_crossattn": [un_cond_emb]}
+
+                shape = (4, H // 8, W // 8)
+                samples, _ = self.ddim_sampler.sample(
+                    params.ddim_steps,
+                    params.num_samples,
+                    shape,
+                    cond,
+                    verbose=False,
+                    eta=params.eta,
+                    unconditional_guidance_scale=params.scale,
+                    unconditional_conditioning=un_cond
+                )
+
+            # VAE decode runs outside autocast, in fp32
+            x_samples = self.model.decode_first_stage(samples.float())
+            # Scale, clamp and cast to uint8 on device so only uint8 crosses to the host
             x_samples = (
-                einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5
-            ).cpu().numpy().clip(0, 255).astype(np.uint8)
+                (x_samples.permute(0, 2, 3, 1) * 127.5 + 127.5)
+                .clamp_(0, 255)
+                .to(torch.uint8)
+                .cpu()
+                .numpy()
+            )
 
             return [x_samples[i] for i in range(params.num_samples)]
 
@@ -165,32 +271,33 @@ def generate_image(image_path: str, prompt: str):
         response = requests.post(f"{BASE_URL}/{job_id}/generate/", json=params)
         response.raise_for_status()
 
-        # 3. Poll for results
-        MAX_RETRIES = 60
-        retries = 0
-
-        while retries < MAX_RETRIES:
-            response = requests.get(f"{BASE_URL}/{job_id}/status/")
-            data = response.json()
-
-            if data["status"] == "completed":
-                for image_name in data["images"]:
-                    image_url = f"{BASE_URL}/{job_id}/result/{image_name}"
-                    response = requests.get(image_url)
-                    response.raise_for_status()
+        # 3. Wait for results on the status stream
+        data = None
+        with requests.get(
+            f"{BASE_URL}/{job_id}/stream/",
+            stream=True,
+            timeout=(10, STREAM_TIMEOUT)
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith("data:"):
+                    data = json.loads(line[len("data:"):])
+                    if data["status"] in ("completed", "failed"):
+                        break
 
-                    output_path = Path(f"output_{image_name}")
-                    output_path.write_bytes(response.content)
-                    print(f"Saved result to {output_path}")
-                break
-            elif data["status"] == "failed":
-                raise Exception("Generation failed")
+        if data is None or data["status"] not in ("completed", "failed"):
+            raise TimeoutError("Generation process timed out")
+        if data["status"] == "failed":
+            raise Exception("Generation failed")
 
-            retries += 1
-            time.sleep(1)
+        for image_name in data["images"]:
+            image_url = f"{BASE_URL}/{job_id}/result/{image_name}"
+            response = requests.get(image_url)
+            response.raise_for_status()
 
-        if retries == MAX_RETRIES:
-            raise TimeoutError("Generation process timed out")
+            output_path = Path(f"output_{image_name}")
+            output_path.write_bytes(response.content)
+            print(f"Saved result to {output_path}")
 
     except requests.exceptions.RequestException as e:
         logger.error(f"HTTP request failed: {e}")
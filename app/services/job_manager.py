@@ -1,46 +1,160 @@
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, List, Optional
 import asyncio
+import itertools
+import secrets
 from pathlib import Path
-import json
 import logging
 
+import numpy as np
+import orjson
+
 from ..models.generation import JobStatus, GenerationParams
 from ..core.config import settings
 from .controlnet import ControlNetService
+from .job_store import JobRecord, create_job_store
 
 logger = logging.getLogger(__name__)
 
+class ModelUnavailableError(RuntimeError):
+    """Raised when a job is submitted but the ControlNet model failed to load."""
+
 class JobManager:
     def __init__(self):
-        self.controlnet = ControlNetService()
-        self._jobs: Dict[str, JobStatus] = {}
-        self._lock = asyncio.Lock()
+        # Loaded by start(), off the event loop, once the app is up
+        self.controlnet: Optional[ControlNetService] = None
+        # Set if loading the model failed; no jobs can run after that
+        self.startup_error: Optional[BaseException] = None
+        self._store = create_job_store()
+        # Job ids are a random per-process prefix plus a counter, so no syscall per id
+        self._job_id_prefix = secrets.token_hex(8)
+        self._job_counter = itertools.count()
+        # Decoded input images from upload, consumed by the first generation
+        self.input_cache: Dict[str, np.ndarray] = {}
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=settings.JOB_QUEUE_SIZE)
+        self._workers: List[asyncio.Task] = []
+
+    def cache_input(self, job_id: str, image: np.ndarray):
+        """Keep an uploaded image in memory, evicting the oldest beyond INPUT_CACHE_SIZE."""
+        self.input_cache[job_id] = image
+        while len(self.input_cache) > settings.INPUT_CACHE_SIZE:
+            self.input_cache.pop(next(iter(self.input_cache)))
+
+    def new_job_id(self) -> str:
+        """Allocate a unique id for a new job."""
+        return f"{self._job_id_prefix}-{next(self._job_counter)}"
+
+    async def load_jobs(self):
+        """Load records of jobs created before this process started."""
+        await self._store.load()
+
+    async def create_job(self, job_id: str):
+        """Register a newly uploaded job."""
+        await self._store.set(job_id, JobRecord())
+
+    async def get_job(self, job_id: str) -> Optional[JobRecord]:
+        """Get the record of a job, or None if it does not exist."""
+        return await self._store.get(job_id)
+
+    def watch_job(self, job_id: str) -> AsyncIterator[JobRecord]:
+        """Yield the current record of a job and then every change until it finishes."""
+        return self._store.watch(job_id)
+
+    async def start(self):
+        """Load the ControlNet model in a thread, then start the worker."""
+        try:
+            self.controlnet = await asyncio.to_thread(ControlNetService)
+        except Exception as e:
+            self.startup_error = e
+            await self._fail_queued_jobs()
+            raise
+        # A single worker: the service runs on one device with one inference thread,
+        # so more workers would only queue behind each other
+        self._workers.append(asyncio.create_task(self._worker()))
+        logger.info("Started job worker")
+
+    async def _fail_queued_jobs(self):
+        """Mark every job still waiting in the queue as failed."""
+        while not self._queue.empty():
+            job_id, _ = self._queue.get_nowait()
+            self._queue.task_done()
+            await self._store.set(job_id, JobRecord(status=JobStatus.FAILED))
+            logger.error(f"Job {job_id} failed: model unavailable")
 
-    def get_job_status(self, job_id: str) -> JobStatus:
-        """Get the current status of a job."""
-        return self._jobs.get(job_id, JobStatus.PENDING)
+    async def stop_workers(self):
+        """Cancel all worker tasks and close the job store."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        await self._store.close()
 
     async def process_job(self, job_id: str, params: GenerationParams):
-        """Process a job asynchronously."""
-        async with self._lock:  # Ensure only one job processes at a time
+        """
+        Queue a job for processing by the worker.
+
+        Raises ModelUnavailableError if the model failed to load and
+        asyncio.QueueFull if the queue is at capacity.
+        """
+        if self.startup_error is not None:
+            raise ModelUnavailableError("ControlNet model failed to load")
+        if self._queue.full():
+            raise asyncio.QueueFull
+
+        # Mark the job pending before queueing it, so the worker's PROCESSING
+        # update can never be overwritten. The store awaits may yield, so the
+        # queue can fill (or the model load fail) in between: restore the
+        # previous record rather than leave a blank PENDING one behind
+        previous = await self._store.get(job_id)
+        await self._store.set(job_id, JobRecord())
+        try:
+            if self.startup_error is not None:
+                raise ModelUnavailableError("ControlNet model failed to load")
+            self._queue.put_nowait((job_id, params))
+        except (asyncio.QueueFull, ModelUnavailableError):
+            if previous is not None:
+                await self._store.set(job_id, previous)
+            raise
+        logger.info(f"Queued job {job_id}")
+
+    async def _worker(self):
+        """Pull jobs off the queue and run them one at a time."""
+        while True:
+            job_id, params = await self._queue.get()
             try:
-                self._jobs[job_id] = JobStatus.PROCESSING
-                logger.info(f"Starting job {job_id}")
-                
-                # Process the image
-                result_paths = await self.controlnet.process_image(job_id, params)
-                
-                # Save job metadata
-                self._save_job_metadata(job_id, params, result_paths)
-                
-                self._jobs[job_id] = JobStatus.COMPLETED
-                logger.info(f"Completed job {job_id}")
-                return result_paths
-
-            except Exception as e:
-                logger.error(f"Job {job_id} failed: {str(e)}")
-                self._jobs[job_id] = JobStatus.FAILED
-                raise
+                await self._run_job(job_id, params)
+            except Exception:
+                # Failure is already recorded on the job; keep the worker alive
+                pass
+            finally:
+                self._queue.task_done()
+
+    async def _run_job(self, job_id: str, params: GenerationParams):
+        """Run a single job and record its status transitions."""
+        try:
+            await self._store.set(job_id, JobRecord(status=JobStatus.PROCESSING))
+            logger.info(f"Starting job {job_id}")
+
+            # Process the image
+            result_paths = await self.controlnet.process_image(
+                job_id,
+                params,
+                input_image=self.input_cache.pop(job_id, None)
+            )
+
+            # Save job metadata
+            self._save_job_metadata(job_id, params, result_paths)
+
+            await self._store.set(job_id, JobRecord(
+                status=JobStatus.COMPLETED,
+                result_files=result_paths
+            ))
+            logger.info(f"Completed job {job_id}")
+            return result_paths
+
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            await self._store.set(job_id, JobRecord(status=JobStatus.FAILED))
+            raise
 
     def _save_job_metadata(
         self,
@@ -55,6 +169,7 @@ class JobManager:
             "results": result_paths,
             "status": JobStatus.COMPLETED
         }
-        
-        with open(job_dir / "metadata.json", "w") as f:
-            json.dump(metadata, f, indent=2) 
\ No newline at end of file
+
+        (job_dir / "metadata.json").write_bytes(
+            orjson.dumps(metadata, option=orjson.OPT_INDENT_2)
+        )
@@ -0,0 +1,147 @@
+from typing import AsyncIterator, Dict, List, Optional
+import asyncio
+from dataclasses import asdict, dataclass, field
+import logging
+
+import orjson
+
+from ..models.generation import JobStatus
+from ..core.config import settings
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = (JobStatus.COMPLETED, JobStatus.FAILED)
+
+@dataclass
+class JobRecord:
+    """Stored state of a job, so status lookups never touch the filesystem."""
+    status: JobStatus = JobStatus.PENDING
+    result_files: List[str] = field(default_factory=list)
+
+    def to_json(self) -> bytes:
+        return orjson.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, data: bytes) -> "JobRecord":
+        record = orjson.loads(data)
+        return cls(status=JobStatus(record["status"]), result_files=record["result_files"])
+
+class MemoryJobStore:
+    """Job records held in this process; used when no REDIS_URL is configured."""
+
+    def __init__(self):
+        self._jobs: Dict[str, JobRecord] = {}
+        # Set (and dropped) on the next status change of a job that is being watched
+        self._job_events: Dict[str, asyncio.Event] = {}
+
+    async def load(self):
+        """Rebuild job records from the jobs directory; called once at startup."""
+        existing = await asyncio.to_thread(self._load_existing_jobs)
+        for job_id, record in existing.items():
+            self._jobs.setdefault(job_id, record)
+
+    def _load_existing_jobs(self) -> Dict[str, JobRecord]:
+        """Scan the jobs directory for job records."""
+        jobs: Dict[str, JobRecord] = {}
+        if not settings.JOBS_DIR.is_dir():
+            return jobs
+        for job_dir in settings.JOBS_DIR.iterdir():
+            if not job_dir.is_dir():
+                continue
+            record = JobRecord()
+            metadata_path = job_dir / "metadata.json"
+            if metadata_path.exists():
+                try:
+                    metadata = orjson.loads(metadata_path.read_bytes())
+                    record = JobRecord(
+                        status=JobStatus(metadata["status"]),
+                        result_files=metadata["results"]
+                    )
+                except Exception as e:
+                    logger.warning(f"Ignoring unreadable metadata for job {job_dir.name}: {str(e)}")
+            jobs[job_dir.name] = record
+        logger.info(f"Loaded {len(jobs)} existing job(s)")
+        return jobs
+
+    async def get(self, job_id: str) -> Optional[JobRecord]:
+        return self._jobs.get(job_id)
+
+    async def set(self, job_id: str, record: JobRecord):
+        self._jobs[job_id] = record
+        event = self._job_events.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def watch(self, job_id: str) -> AsyncIterator[JobRecord]:
+        while True:
+            record = self._jobs[job_id]
+            if record.status in FINISHED_STATUSES:
+                yield record
+                return
+            event = self._job_events.setdefault(job_id, asyncio.Event())
+            yield record
+            await event.wait()
+
+    async def close(self):
+        pass
+
+class RedisJobStore:
+    """
+    Job records in a Redis hash, shared by every API worker and kept across restarts.
+
+    Status changes are also published on a per-job channel for watch().
+    """
+
+    KEY = "controlnet:jobs"
+
+    def __init__(self, url: str):
+        import redis.asyncio
+
+        self._redis = redis.asyncio.Redis.from_url(url)
+
+    async def load(self):
+        # Records persist in Redis, there is nothing to rebuild
+        pass
+
+    def _channel(self, job_id: str) -> str:
+        return f"{self.KEY}:{job_id}"
+
+    async def get(self, job_id: str) -> Optional[JobRecord]:
+        data = await self._redis.hget(self.KEY, job_id)
+        return JobRecord.from_json(data) if data is not None else None
+
+    async def set(self, job_id: str, record: JobRecord):
+        data = record.to_json()
+        await self._redis.hset(self.KEY, job_id, data)
+        await self._redis.publish(self._channel(job_id), data)
+
+    async def watch(self, job_id: str) -> AsyncIterator[JobRecord]:
+        pubsub = self._redis.pubsub()
+        # Subscribe before reading the current record so no transition is missed
+        await pubsub.subscribe(self._channel(job_id))
+        try:
+            record = await self.get(job_id)
+            if record is None:
+                return
+            yield record
+            if record.status in FINISHED_STATUSES:
+                return
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                record = JobRecord.from_json(message["data"])
+                yield record
+                if record.status in FINISHED_STATUSES:
+                    return
+        finally:
+            await pubsub.aclose()
+
+    async def close(self):
+        await self._redis.aclose()
+
+def create_job_store():
+    """Create the job store selected by settings.REDIS_URL."""
+    if settings.REDIS_URL:
+        logger.info("Using Redis job store")
+        return RedisJobStore(settings.REDIS_URL)
+    return MemoryJobStore()
@@ -5,17 +5,29 @@ from omegaconf import OmegaConf
 from ldm.util import instantiate_from_config
 
 
+def _torch_version():
+    return tuple(int(part) for part in torch.__version__.split('+')[0].split('.')[:2])
+
+
 def get_state_dict(d):
     return d.get('state_dict', d)
 
 
-def load_state_dict(ckpt_path, location='cpu'):
+def load_state_dict(ckpt_path, location='cpu', mmap=False):
     _, extension = os.path.splitext(ckpt_path)
     if extension.lower() == ".safetensors":
         import safetensors.torch
         state_dict = safetensors.torch.load_file(ckpt_path, device=location)
     else:
-        state_dict = get_state_dict(torch.load(ckpt_path, map_location=torch.device(location)))
+        state_dict = None
+        # torch.load(mmap=True) needs torch>=2.1 and a zipfile-format checkpoint
+        if mmap and _torch_version() >= (2, 1):
+            try:
+                state_dict = torch.load(ckpt_path, map_location=torch.device(location), mmap=True)
+            except RuntimeError:
+                print(f'Cannot mmap [{ckpt_path}], loading it into memory')
+        if state_dict is None:
+            state_dict = torch.load(ckpt_path, map_location=torch.device(location))
     state_dict = get_state_dict(state_dict)
     print(f'Loaded state_dict from [{ckpt_path}]')
     return state_dict